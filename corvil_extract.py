@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+"""Extract message-csv data from a Corvil appliance.
+
+Wraps CorvilApiStreamingClient.py, converts the comma separated output to
+SOH delimited form via csv-comma2soh, optionally compresses the extract and
+writes manifest files for downstream loaders.  Extract windows, appliances
+and field lists are driven by ref_corvil.yaml.
+"""
+
+import argparse
+import atexit
+import gzip
+import io
+import itertools
+import mmap
+import os
+import pickle
+import platform
+import shlex
+import smtplib
+import subprocess
+import sys
+from email.mime.text import MIMEText
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+PYTHON = "python"
+CORVIL_UTILITY = "CorvilApiStreamingClient.py"
+CORVIL_CONFIG = "ref_corvil.yaml"
+
+MAIL_FROM = "corvil-extract@localhost"
+MAIL_TO = "market-data-support@localhost"
+
+
+def file_lcount(fname):
+    """Count the lines in a gzipped file."""
+    n = 0
+    with io.BufferedReader(gzip.open(fname, "rb"), buffer_size=1 << 17) as f:
+        buf = f.read1(1 << 20)
+        while buf:
+            n += buf.count(b"\n")
+            buf = f.read1(1 << 20)
+    return n
+
+
+_smtp_singleton = None
+
+
+def _close_smtp():
+    if _smtp_singleton is not None:
+        try:
+            _smtp_singleton.quit()
+        except smtplib.SMTPException:
+            pass
+
+
+atexit.register(_close_smtp)
+
+
+def send_mail(subject, body):
+    """Mail an operational warning to the support list.
+
+    The SMTP connection is kept open between calls so a batch run that
+    raises several warnings only pays the connect/EHLO handshake once;
+    a dead connection is detected with NOOP and reopened.
+    """
+    global _smtp_singleton
+    s = _smtp_singleton
+    try:
+        s.noop()
+    except (AttributeError, smtplib.SMTPException, OSError):
+        s = smtplib.SMTP("localhost")
+        _smtp_singleton = s
+    msg = MIMEText(body)
+    msg["Subject"] = subject
+    msg["From"] = MAIL_FROM
+    msg["To"] = MAIL_TO
+    s.sendmail(MAIL_FROM, [MAIL_TO], msg.as_string())
+
+
+def run_command(command):
+    """Run a shell command, returning its exit status."""
+    return subprocess.call(command, shell=True)
+
+
+def _unlink_if_exists(path, logfile):
+    """Remove a file if present, without a preflight stat."""
+    try:
+        os.remove(path)
+        logfile.write("Deleting {}\n".format(path))
+    except FileNotFoundError:
+        pass
+
+
+SOH_TO_COMMA = bytes.maketrans(b"\x01", b",")
+
+
+class UringWriter:
+    """Sequential file writer that submits writes through io_uring.
+
+    The sink hands this multi-megabyte chunks, so waiting on the CQE
+    after each submit keeps the code synchronous while still cutting
+    per-write syscall overhead on the kernel side.  Requires the
+    python liburing package.
+    """
+
+    def __init__(self, path, depth=4):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.ring = liburing.io_uring()
+        liburing.io_uring_queue_init(depth, self.ring, 0)
+        self.offset = 0
+
+    def write(self, data):
+        mv = memoryview(data)
+        length = len(mv)
+        written = 0
+        while written < length:
+            # The SQE only holds a pointer to the buffer, so the chunk
+            # must stay referenced until the CQE has been reaped; a
+            # memoryview also avoids copying the remainder on short
+            # writes.
+            chunk = mv[written:]
+            sqe = liburing.io_uring_get_sqe(self.ring)
+            liburing.io_uring_prep_write(
+                sqe, self.fd, chunk, len(chunk), self.offset
+            )
+            liburing.io_uring_submit(self.ring)
+            cqe = liburing.io_uring_cqe()
+            liburing.io_uring_wait_cqe(self.ring, cqe)
+            res = liburing.trap_error(cqe.res)
+            liburing.io_uring_cqe_seen(self.ring, cqe)
+            chunk.release()
+            written += res
+            self.offset += res
+        return written
+
+    def close(self):
+        liburing.io_uring_queue_exit(self.ring)
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stream_extract(
+    command, out_path, compress=False, human=False, uring=False, gzip_level=1
+):
+    """Run an extract command and write its output through a Python sink.
+
+    Replaces the tr and gzip stages of the old shell pipeline: the
+    SOH-to-comma translation is a single byte substitution done with
+    bytes.translate and compression happens in-process with GzipFile,
+    so every chunk crosses one pipe instead of three.  Returns the
+    pipeline's exit status.
+    """
+    proc = subprocess.Popen(
+        command, shell=True, stdout=subprocess.PIPE, bufsize=1 << 20
+    )
+    if uring and liburing is not None:
+        raw = UringWriter(out_path)
+    else:
+        raw = open(out_path, "wb")
+    if compress:
+        sink = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=gzip_level)
+    else:
+        sink = raw
+    try:
+        while True:
+            chunk = proc.stdout.read(1 << 20)
+            if not chunk:
+                break
+            if human:
+                chunk = chunk.translate(SOH_TO_COMMA)
+            sink.write(chunk)
+    finally:
+        sink.close()
+        if sink is not raw:
+            raw.close()
+    return proc.wait()
+
+
+def load_config(corvil_file_str):
+    """Parse the Corvil config, caching the parsed tree next to the yaml.
+
+    PyYAML parsing dominates startup on large configs, so the parsed tree
+    is pickled to a <config>.pkl sidecar keyed by the yaml's mtime and
+    reloaded from there while the yaml is unchanged.
+    """
+    cache_file = corvil_file_str + ".pkl"
+    mtime = os.path.getmtime(corvil_file_str)
+    try:
+        with open(cache_file, "rb") as pf:
+            cached_mtime, config = pickle.load(pf)
+        if cached_mtime == mtime:
+            return config
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    with open(corvil_file_str) as config_file:
+        config = yaml.load(config_file, Loader=SafeLoader)
+    try:
+        with open(cache_file, "wb") as pf:
+            pickle.dump((mtime, config), pf, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+    return config
+
+
+def _extract_complete(properties):
+    """True if an extract names a cne, an rt-class and a decoder extract."""
+    return bool(
+        properties.get("cne")
+        and properties.get("rt-class")
+        and properties.get("decoder_extracts")
+    )
+
+
+def get_valid_extracts(corvilConfig):
+    """Return the markets/extracts from the config that are fully specified.
+
+    Partially filled in entries are skipped.
+    """
+    return {
+        key: {
+            extract: properties
+            for extract, properties in value["extracts"].items()
+            if _extract_complete(properties)
+        }
+        for key, value in corvilConfig["markets"].items()
+        if "extracts" in value
+    }
+
+
+def verify_cols(verify_field_list, col_list):
+    """Check the extract header row against the configured field list.
+
+    The matching case is a single list equality (one C loop); on a
+    mismatch the first offending column is located and reported.
+    """
+    if verify_field_list == col_list:
+        return True
+    mismatch = next(
+        (
+            i
+            for i, (expected, got) in enumerate(zip(verify_field_list, col_list))
+            if expected != got
+        ),
+        -1,
+    )
+    if mismatch == -1:
+        print(
+            "Column count mismatch: expected {} columns, received {}".format(
+                len(verify_field_list), len(col_list)
+            )
+        )
+    else:
+        print(
+            "Column {} mismatch: expected {}, received {}".format(
+                mismatch, verify_field_list[mismatch], col_list[mismatch]
+            )
+        )
+    return False
+
+
+def main():
+    corvil_file_str = CORVIL_CONFIG
+    corvilConfig = load_config(corvil_file_str)
+    valid_extracts = get_valid_extracts(corvilConfig)
+
+    parser = argparse.ArgumentParser(
+        description="Extract message-csv data from a Corvil appliance."
+    )
+    parser.add_argument(
+        "-m", "--mic", required=True, choices=valid_extracts.keys(),
+        help="market identifier code to extract",
+    )
+    parser.add_argument(
+        "-e", "--extract", required=True, help="extract name within the market"
+    )
+    parser.add_argument(
+        "-s", "--start_time", required=True,
+        help='extract window start, "YYYY-MM-DD HH:MM:SS"',
+    )
+    parser.add_argument(
+        "-t", "--end_time", required=True,
+        help='extract window end, "YYYY-MM-DD HH:MM:SS"',
+    )
+    parser.add_argument(
+        "-f", "--filename", required=True,
+        help="output file path, without extension",
+    )
+    parser.add_argument("-n", "--username", default="admin", help="appliance username")
+    parser.add_argument("-p", "--password", default="admin", help="appliance password")
+    parser.add_argument(
+        "--mnemonic", default="", help="mnemonic written to manifest entries"
+    )
+    parser.add_argument(
+        "--console", action="store_true",
+        help="write the extract to stdout instead of a file",
+    )
+    parser.add_argument("--compress", action="store_true", help="gzip the extract")
+    parser.add_argument(
+        "--human", action="store_true",
+        help="comma separated output instead of SOH delimited",
+    )
+    parser.add_argument(
+        "--manifest", action="store_true",
+        help="write a .manifest file per compressed extract",
+    )
+    parser.add_argument(
+        "--testing",
+        type=lambda s: s.strip().lower() in ("true", "1", "yes"),
+        default=False,
+        help="testing mode, suppresses warning mails",
+    )
+    parser.add_argument(
+        "--wildcard", action="store_true",
+        help="extract all fields instead of the configured field list",
+    )
+    parser.add_argument(
+        "--no_verify", action="store_true", help="skip column verification"
+    )
+    parser.add_argument(
+        "--gzip-level", type=int, default=1, choices=range(1, 10),
+        help="gzip compression level; 1 is the throughput sweet spot for"
+        " csv market data, bump it if disk is the constraint",
+    )
+    parser.add_argument(
+        "--uring", action="store_true",
+        help="write the extract through io_uring (needs the liburing package)",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true",
+        help="remove an existing extract before running",
+    )
+    args = parser.parse_args()
+
+    if args.extract not in valid_extracts[args.mic]:
+        print(
+            "Unknown extract {} for mic {}, valid extracts are: {}".format(
+                args.extract, args.mic, ", ".join(valid_extracts[args.mic].keys())
+            )
+        )
+        sys.exit(1)
+
+    properties = valid_extracts[args.mic][args.extract]
+    ip_address = properties["cne"]
+    rt_class = properties["rt-class"]
+    decoder_extract = properties["decoder_extracts"]
+
+    de = corvilConfig["decoder_extracts"][decoder_extract]
+    field_list = ",".join(de["extract_fields"])
+    corvil_added_fields = de["corvil_added_fields"]
+
+    uring = args.uring
+    if uring and liburing is None:
+        print("liburing is not installed, falling back to buffered writes")
+        uring = False
+
+    # Bind the frequently consulted options to locals once; everything
+    # below is LOAD_FAST instead of attribute lookups on the Namespace.
+    filename = args.filename
+    start_time = args.start_time
+    end_time = args.end_time
+    testing = args.testing
+    console = args.console
+    compress = args.compress
+    human = args.human
+    manifest = args.manifest
+    mnemonic = args.mnemonic
+    wildcard = args.wildcard
+    no_verify = args.no_verify
+    overwrite = args.overwrite
+
+    logfile = open(filename + ".log", "a")
+
+    # Everything interpolated here comes from the CLI or the config, so
+    # quote it all; an unquoted special character in a password or field
+    # name breaks the whole extract and forces an operator retry.
+    base_cmd = (
+        f"{PYTHON} ./{CORVIL_UTILITY} -c -b"
+        f" -n {shlex.quote(args.username)} -p {shlex.quote(args.password)}"
+        f" message-csv {shlex.quote(ip_address)} {shlex.quote(rt_class)}"
+        f" {shlex.quote(start_time)} {shlex.quote(end_time)}"
+    )
+    if not wildcard:
+        base_cmd += f" {shlex.quote(field_list)}"
+
+    verify_test_filename = filename + "_verify_cols.csv"
+
+    if platform.system() == "Linux":
+        if overwrite:
+            _unlink_if_exists(filename + ".csv", logfile)
+            if compress:
+                _unlink_if_exists(filename + ".csv.gz", logfile)
+
+        if console:
+            final_command = base_cmd + " | ./csv-comma2soh | tr '\\001' ','"
+            run_command(final_command)
+        else:
+            extract_cmd = base_cmd + " | ./csv-comma2soh"
+
+            logfile.write("Running {}\n".format(extract_cmd))
+            if compress and not human:
+                out_file = filename + ".csv.gz"
+                status = stream_extract(
+                    extract_cmd, out_file, compress=True, uring=uring,
+                    gzip_level=args.gzip_level,
+                )
+            else:
+                out_file = filename + ".csv"
+                status = stream_extract(
+                    extract_cmd, out_file, human=human, uring=uring
+                )
+
+            if not no_verify:
+                # Check the header row of the extract we just wrote; the
+                # old separate one second "test" extract doubled the API
+                # calls and client startup for the same information.
+                first_line = ""
+                if status != 0 or os.path.getsize(out_file) == 0:
+                    # A failed or empty extract has no header row; leave
+                    # first_line empty so it is reported as a verification
+                    # failure rather than crashing on the empty file.
+                    logfile.write(
+                        "Extract command exited {} with {} bytes of"
+                        " output\n".format(status, os.path.getsize(out_file))
+                    )
+                elif compress and not human:
+                    # Decompression stops after six lines, so only a few
+                    # KB of the archive are ever inflated.
+                    with gzip.open(out_file, "rb") as gz:
+                        header = next(itertools.islice(gz, 5, 6), b"")
+                    first_line = header.decode()
+                else:
+                    # Header row sits on line 6, after the five line
+                    # preamble; locate it via mmap instead of decoding
+                    # the throwaway lines in front of it.
+                    with open(out_file, "rb") as tf:
+                        mm = mmap.mmap(tf.fileno(), 0, access=mmap.ACCESS_READ)
+                        pos = 0
+                        for _ in range(5):
+                            pos = mm.find(b"\n", pos) + 1
+                        end = mm.find(b"\n", pos)
+                        if end == -1:
+                            end = len(mm)
+                        first_line = mm[pos:end].decode()
+                        with open(verify_test_filename, "wb") as vf:
+                            vf.write(mm[pos : end + 1])
+                        mm.close()
+
+                verify_field_list = [
+                    *corvil_added_fields,
+                    *(f.replace('"', "") for f in de["extract_fields"]),
+                ]
+                col_list = first_line.strip().replace("\001", ",").split(",")
+                if not verify_cols(verify_field_list, col_list):
+                    logfile.write("Column verification failed for {}\n".format(filename))
+                    send_mail(
+                        "Corvil extract column mismatch: {}".format(args.mic),
+                        "Column verification failed for {} ({} {})\n"
+                        "expected: {}\nreceived: {}\n".format(
+                            filename, args.mic, args.extract,
+                            verify_field_list, col_list,
+                        ),
+                    )
+                    os.remove(out_file)
+                    sys.exit(1)
+                _unlink_if_exists(verify_test_filename, logfile)
+
+            if compress and not human:
+                logfile.write(
+                    "{} lines extracted\n".format(file_lcount(filename + ".csv.gz"))
+                )
+
+            if manifest and compress and not human:
+                f_name = os.path.basename(filename)
+                f_path = os.path.dirname(filename) or "."
+                # Downstream loaders expect one .manifest per .gz, so the
+                # manifests stay per-file; the scan itself is one pass over
+                # the cached dirents with the writes and warning mails done
+                # afterwards.
+                manifests = []
+                small_files = []
+                for entry in os.scandir(f_path):
+                    if not entry.is_file():
+                        continue
+                    name = entry.name
+                    if not name.startswith(f_name) or not name.endswith(".gz"):
+                        continue
+                    size = entry.stat().st_size
+                    if size < 5000 and not testing:
+                        small_files.append((name, size))
+                    manifests.append(
+                        (
+                            os.path.join(f_path, name[:-3] + ".manifest"),
+                            "{}|{}|{}|0\n".format(mnemonic, name, size),
+                        )
+                    )
+                for path, line in manifests:
+                    with open(path, "w") as mf:
+                        mf.write(line)
+                for name, size in small_files:
+                    send_mail(
+                        "Corvil extract small file warning: {}".format(name),
+                        "Extract {} is only {} bytes, please check the"
+                        " extract window.\n".format(name, size),
+                    )
+    else:
+        print("{} is not supported, Linux only.".format(platform.system()))
+        sys.exit(1)
+
+    logfile.close()
+
+
+if __name__ == "__main__":
+    main()